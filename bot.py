@@ -1,16 +1,24 @@
 import os
+import functools
+import hashlib
 import logging
+import heapq
+import math
+import re
+import signal
 import sys
-import psutil
+import socket
+import time
 import sqlite3
-import json
-from datetime import datetime
+from collections import OrderedDict
 import asyncio
 import threading
-import requests
+import orjson
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
 
+from aiohttp import web
 from dotenv import load_dotenv
-from flask import Flask, request
 
 from telegram import (
     Update,
@@ -18,7 +26,7 @@ from telegram import (
 )
 from telegram.constants import ChatAction
 from telegram.ext import (
-    Application,
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -30,24 +38,17 @@ from telegram.ext import (
 from telegram.request import HTTPXRequest
 
 # -----------------------------
-# Попытка подключить spaCy, openai, huggingface
+# Попытка подключить openai, huggingface
 # -----------------------------
-try:
-    import spacy
-    nlp_uk = spacy.load("uk_core_news_sm")  # украинская модель spaCy
-except:
-    nlp_uk = None
-
 try:
     import openai
 except:
     openai = None
 
 try:
-    from transformers import pipeline
-    sentiment_pipeline = pipeline("sentiment-analysis", model="cardiffnlp/twitter-roberta-base-sentiment-latest")
-except:
-    sentiment_pipeline = None
+    import uvloop
+except ImportError:
+    uvloop = None  # Windows / не установлен — обычный asyncio loop
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -65,19 +66,33 @@ WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL", "")
 if openai and OPENAI_API_KEY:
     openai.api_key = OPENAI_API_KEY
 
+# Общая aiohttp-сессия для OpenAI: keep-alive вместо нового TLS-соединения на каждый запрос
+openai_session = None
+
+def use_openai_session():
+    global openai_session
+    if openai_session is None or openai_session.closed:
+        openai_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=20))
+    openai.aiosession.set(openai_session)
+
 # -----------------------------
 # Проверка, не запущен ли бот вторым процессом
 # -----------------------------
-def is_bot_already_running():
-    current_process = psutil.Process()
-    for process in psutil.process_iter(['pid', 'name', 'cmdline']):
-        if (
-            process.info['name'] == current_process.name()
-            and process.info['cmdline'] == current_process.cmdline()
-            and process.info['pid'] != current_process.pid
-        ):
-            return True
-    return False
+INSTANCE_LOCK_PORT = int(os.getenv("INSTANCE_LOCK_PORT", "47251"))
+instance_lock_sock = None
+
+def acquire_instance_lock() -> bool:
+    """Занимает локальный порт-замок; False — если бот уже запущен"""
+    global instance_lock_sock
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("127.0.0.1", INSTANCE_LOCK_PORT))
+    except OSError:
+        sock.close()
+        return False
+    # Сокет держим открытым всё время работы процесса; ОС освободит порт при выходе
+    instance_lock_sock = sock
+    return True
 
 # -----------------------------
 # СЦЕНАРНЫЕ ТЕКСТЫ (вместо scenario.py)
@@ -137,6 +152,7 @@ FALLBACK_TEXT = (
 # -----------------------------
 # Conversation states
 # -----------------------------
+ALL_STAGES = range(19)
 (
     STAGE_SCENARIO_CHOICE,  
     STAGE_CAMP_PHONE,       
@@ -158,142 +174,480 @@ FALLBACK_TEXT = (
     STAGE_ZOO_END,
     STAGE_CAMP_CITY,
     STAGE_CAMP_CHILDREN
-) = range(19)
+) = ALL_STAGES
+FINISHED_STAGES = frozenset((STAGE_CAMP_END, STAGE_ZOO_END))
+
+# Один экземпляр фильтра на все стейты и fallback
+TEXT_NOCMD = filters.TEXT & ~filters.COMMAND
 
 NO_RESPONSE_DELAY_SECONDS = 6*3600
+QUICK_NO_RESPONSE_DELAY_SECONDS = 300
+NO_RESPONSE_CHECK_INTERVAL_SECONDS = 30
 
-app = Flask(__name__)
 application = None
+# Горячий путь webhook: бот и очередь апдейтов, заполняются в run_bot
+_bot = None
+_update_queue = None
 
 # ============================
 # DB init / load / save
 # ============================
-def init_db():
-    conn = sqlite3.connect("bot_database.db")
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS conversation_state (
-            user_id TEXT PRIMARY KEY,
-            current_stage INTEGER,
-            user_data TEXT,
-            last_interaction TIMESTAMP
-        )
-    """)
-    conn.commit()
-    conn.close()
+# STATE_DB_PATH=:memory: — состояние только в памяти процесса, без записи на диск
+DB_PATH = os.getenv("STATE_DB_PATH", "bot_database.db")
+PERSIST_STATE = DB_PATH != ":memory:"
+
+SELECT_STATE_SQL = "SELECT current_stage,user_data FROM conversation_state WHERE user_id=?"
+UPSERT_STATE_SQL = """
+    INSERT OR REPLACE INTO conversation_state
+    (user_id, current_stage, user_data, last_interaction)
+    VALUES (?,?,?,?)
+"""
+
+# Одно долгоживущее соединение вместо connect/close на каждый вызов
+db_conn = None
+db_lock = threading.Lock()
+# Один поток-писатель: SQLite допускает только одного писателя
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+# Кэш состояний — источник истины; в БД изменения сбрасываются пачками
+STATE_FLUSH_INTERVAL_SECONDS = 2
+# Сверх этого в памяти остаются только недавние пользователи (LRU); остальные читаются из БД
+STATE_CACHE_SIZE = 10_000
+state_cache = OrderedDict()
+dirty_users = set()
+# Ключи user_data, которые сохраняются в БД; всё остальное живёт только в памяти
+PERSISTED_KEYS = frozenset([
+    "scenario", "current_stage", "hist_roles", "hist_texts", "last_objection",
+    "phone", "city", "children", "departure", "choice",
+    "phone_processed", "qa_processed", "city_processed", "children_processed",
+    "detailed_processed", "zoo_details_processed", "zoo_questions_processed",
+])
+
+def persisted_fields(user_data:dict) -> dict:
+    return {k: v for k, v in user_data.items() if k in PERSISTED_KEYS}
+
+# Дайджест последней записанной строки: неизменённое состояние повторно не пишем
+written_digests = {}
+# Будит state_flusher только когда есть что писать; в простое он не просыпается
+state_dirty = asyncio.Event()
 
-def load_user_state(user_id:str):
-    conn = sqlite3.connect("bot_database.db")
-    c = conn.cursor()
-    c.execute("SELECT current_stage,user_data FROM conversation_state WHERE user_id=?",(user_id,))
-    row = c.fetchone()
-    conn.close()
+def init_db():
+    global db_conn
+    with db_lock:
+        if db_conn is not None:
+            return
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=128)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                user_id TEXT PRIMARY KEY,
+                current_stage INTEGER,
+                user_data TEXT,
+                last_interaction INTEGER
+            )
+        """)
+        db_conn = conn
+
+def _load_from_db(user_id:str):
+    if db_conn is None:
+        init_db()
+    with db_lock:
+        row = db_conn.execute(SELECT_STATE_SQL, (user_id,)).fetchone()
     if row:
-        return row[0], row[1]
+        return row[0], persisted_fields(orjson.loads(row[1]))
     return None,None
 
+def load_user_state(user_id:str):
+    """Возвращает (stage, user_data): сначала из кэша, при промахе — из БД"""
+    if not PERSIST_STATE:
+        return None, None
+    cached = state_cache.get(user_id)
+    if cached:
+        state_cache.move_to_end(user_id)
+        return cached
+    stage, user_data = _load_from_db(user_id)
+    if stage is not None:
+        state_cache[user_id] = (stage, user_data)
+    return stage, user_data
+
 def save_user_state(user_id:str, stage:int, user_data:dict):
-    conn = sqlite3.connect("bot_database.db")
-    c = conn.cursor()
-    ud_json = json.dumps(user_data, ensure_ascii=False)
-    now = datetime.now().isoformat()
-    c.execute("""
-        INSERT OR REPLACE INTO conversation_state 
-        (user_id, current_stage, user_data, last_interaction)
-        VALUES (?,?,?,?)
-    """,(user_id, stage, ud_json, now))
-    conn.commit()
-    conn.close()
+    """Обновляет кэш; в БД состояние попадёт при ближайшем сбросе state_flusher"""
+    # Без БД кэш лишь дублировал бы user_data из PTB и рос бы без сброса
+    if not PERSIST_STATE:
+        return
+    state_cache[user_id] = (stage, user_data)
+    state_cache.move_to_end(user_id)
+    dirty_users.add(user_id)
+    state_dirty.set()
+
+def write_user_states(rows:list):
+    if db_conn is None:
+        init_db()
+    with db_lock:
+        db_conn.execute("BEGIN IMMEDIATE")
+        try:
+            db_conn.executemany(UPSERT_STATE_SQL, rows)
+            db_conn.execute("COMMIT")
+        except Exception:
+            db_conn.execute("ROLLBACK")
+            raise
+
+async def flush_user_states():
+    """Сериализует изменённые состояния и пишет их в БД одной транзакцией"""
+    if not dirty_users:
+        return
+    now = int(time.time())
+    rows = []
+    digests = {}
+    for user_id in list(dirty_users):
+        stage, user_data = state_cache[user_id]
+        try:
+            payload = orjson.dumps(persisted_fields(user_data))
+        except (TypeError, ValueError) as e:
+            logger.error(f"Не удалось сериализовать состояние {user_id}: {e}")
+            continue
+        digest = (stage, hashlib.blake2b(payload, digest_size=16).digest())
+        if written_digests.get(user_id) == digest:
+            continue
+        digests[user_id] = digest
+        rows.append((user_id, stage, payload, now))
+    dirty_users.clear()
+    if not rows:
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(db_executor, write_user_states, rows)
+    except (Exception, asyncio.CancelledError):
+        # Не теряем изменения: попробуем записать их при следующем сбросе
+        # (в том числе финальном, если сброс отменили на выходе)
+        dirty_users.update(row[0] for row in rows)
+        state_dirty.set()
+        raise
+    written_digests.update(digests)
+    # Завершённые диалоги уже на диске — в памяти их больше не держим
+    for user_id, (stage, _) in digests.items():
+        if stage in FINISHED_STAGES and user_id not in dirty_users:
+            state_cache.pop(user_id, None)
+            written_digests.pop(user_id, None)
+    # Большинство диалогов до конца не доходит: давно молчащих тоже выгружаем
+    if len(state_cache) > STATE_CACHE_SIZE:
+        for user_id in list(state_cache):
+            if len(state_cache) <= STATE_CACHE_SIZE:
+                break
+            if user_id not in dirty_users:
+                del state_cache[user_id]
+                written_digests.pop(user_id, None)
+
+async def state_flusher():
+    while True:
+        await state_dirty.wait()
+        # Копим изменения за окно, чтобы частые сообщения одного пользователя дали одну запись
+        await asyncio.sleep(STATE_FLUSH_INTERVAL_SECONDS)
+        state_dirty.clear()
+        try:
+            await flush_user_states()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояния: {e}")
+
+# ============================
+# Helpers
+# ============================
+def uid(update: Update) -> str:
+    """ID пользователя в виде строки (ключ в conversation_state)"""
+    return str(update.effective_user.id)
+
+def append_history(user_data: dict, role: str, content: str) -> None:
+    """Добавляет реплику в историю (роли и тексты хранятся параллельными списками)"""
+    user_data.setdefault("hist_roles", []).append(role)
+    user_data.setdefault("hist_texts", []).append(content)
 
 # ============================
 # No response job
 # ============================
-def no_response_callback(context:CallbackContext):
-    chat_id = context.job.chat_id
-    text = (
-        "Схоже, що ви зайняті. Якщо бажаєте дізнатися більше про наші пропозиції (зимовий табір чи зоопарк), "
-        "пишіть мені, я завжди на зв'язку! 😊"
-    )
-    context.bot.send_message(chat_id=chat_id, text=text)
+NO_RESPONSE_TEXT = (
+    "Схоже, що ви зайняті. Якщо бажаєте дізнатися більше про наші пропозиції (зимовий табір чи зоопарк), "
+    "пишіть мені, я завжди на зв'язку! 😊"
+)
 
-def schedule_no_response_job(context:CallbackContext, chat_id:int):
-    jq = context.job_queue
-    jobs = jq.get_jobs_by_name(f"noresp_{chat_id}")
-    for j in jobs:
-        j.schedule_removal()
-    jq.run_once(no_response_callback, NO_RESPONSE_DELAY_SECONDS, chat_id=chat_id, name=f"noresp_{chat_id}")
+# chat_id -> момент (time.monotonic()), когда отправить напоминание
+no_response_deadlines = {}
+# Мин-куча (deadline, chat_id) для одной фоновой задачи вместо job на каждый чат.
+# Отменённые и перенесённые записи не удаляются сразу, а пропускаются при извлечении.
+no_response_heap = []
+
+def schedule_no_response_job(context:CallbackContext, chat_id:int, delay:float=NO_RESPONSE_DELAY_SECONDS):
+    deadline = time.monotonic() + delay
+    no_response_deadlines[chat_id] = deadline
+    heapq.heappush(no_response_heap, (deadline, chat_id))
+    # Не даём куче разрастись устаревшими записями
+    if len(no_response_heap) > 2 * len(no_response_deadlines) + 1024:
+        no_response_heap[:] = [(d, c) for c, d in no_response_deadlines.items()]
+        heapq.heapify(no_response_heap)
 
 def cancel_no_response_job(context:CallbackContext):
-    jq = context.job_queue
     chat_id = context._chat_id if hasattr(context,'_chat_id') else None
     if chat_id:
-        jobs = jq.get_jobs_by_name(f"noresp_{chat_id}")
-        for j in jobs:
-            j.schedule_removal()
+        no_response_deadlines.pop(chat_id, None)
+
+def resets_no_response(handler):
+    """Декоратор хендлера стадии: новое сообщение снимает таймер отсутствия ответа"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext):
+        cancel_no_response_job(context)
+        return await handler(update, context)
+    return wrapper
+
+async def no_response_watcher(bot):
+    """Отправляет напоминания чатам, у которых истёк таймер"""
+    while True:
+        now = time.monotonic()
+        while no_response_heap and no_response_heap[0][0] <= now:
+            deadline, chat_id = heapq.heappop(no_response_heap)
+            if no_response_deadlines.get(chat_id) != deadline:
+                continue  # таймер отменён или перенесён
+            del no_response_deadlines[chat_id]
+            try:
+                await bot.send_message(chat_id=chat_id, text=NO_RESPONSE_TEXT)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке напоминания в чат {chat_id}: {e}")
+        delay = NO_RESPONSE_CHECK_INTERVAL_SECONDS
+        if no_response_heap:
+            delay = min(delay, max(no_response_heap[0][0] - time.monotonic(), 0))
+        await asyncio.sleep(delay)
 
 # ============================
 # Typing simulation
 # ============================
+SIMULATE_TYPING = os.getenv("SIMULATE_TYPING", "1") == "1"
+KEYBOARD_REMOVE = ReplyKeyboardRemove()
+TYPING_MIN_CHARS = 80
+TYPING_CHARS_PER_SECOND = 140
+TYPING_MAX_DELAY_SECONDS = 1.5
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+background_tasks = set()
+
+def _finish_background_task(task: asyncio.Task) -> None:
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Фоновая задача завершилась с ошибкой: {task.exception()}")
+
+def fire_and_forget(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_finish_background_task)
+    return task
+
 async def typing_simulation(update: Update, text: str) -> None:
     """Симулирует набор текста и отправляет сообщение"""
-    # Отправляем действие "печатает"
-    await update.effective_chat.send_action(action=ChatAction.TYPING)
-    
-    # Рассчитываем задержку на основе длины текста
-    delay = min(len(text) * 0.05, 2.0)  # максимум 2 секунды
-    
-    # Ждем
-    await asyncio.sleep(delay)
+    chat = update.effective_chat
+    # Короткие ответы отправляем сразу; "печатает" не ждём — это лишний round-trip
+    if SIMULATE_TYPING and len(text) > TYPING_MIN_CHARS:
+        fire_and_forget(chat.send_action(action=ChatAction.TYPING))
+        await asyncio.sleep(min(len(text) / TYPING_CHARS_PER_SECOND, TYPING_MAX_DELAY_SECONDS))
     
     # Отправляем сообщение
-    await update.effective_chat.send_message(
+    await chat.send_message(
         text=text,
-        reply_markup=ReplyKeyboardRemove(),
+        reply_markup=KEYBOARD_REMOVE,
         parse_mode='HTML'
     )
 
+async def transition(update: Update, context: CallbackContext, text: str, new_stage: int, schedule: bool = True) -> int:
+    """Сохраняет новую стадию, (по умолчанию) ставит таймер отсутствия ответа и отправляет ответ"""
+    # Состояние и таймер — до отправки: они не ждут Telegram и не теряются, если отправка упадёт
+    context.user_data["current_stage"] = new_stage
+    save_user_state(uid(update), new_stage, context.user_data)
+    if schedule:
+        schedule_no_response_job(context, update.effective_chat.id)
+    await typing_simulation(update, text)
+    return new_stage
+
 # ============================
 # Intent detection
 # ============================
+POSITIVE_KEYWORDS = frozenset(["так","добре","да","ок","продовжуємо","розкажіть","готовий","готова","привіт","hello","yes","зацікав","sure","no problem"])
+NEGATIVE_KEYWORDS = frozenset(["не хочу","не можу","нет","ні","не буду","не зараз","no"])
+# Основы слов среди ключевых слов намерения и возражений: совпадают с началом слова ("зацікавило").
+# Остальные слова и фразы ищутся только целиком, иначе "ок" находится в "квиток", а "да" — в "додаткові"
+INTENT_STEMS = frozenset(["зацікав", "передума"])
+CAMP_KEYWORDS = frozenset(["лапланд","карпат","лагерь","camp"])
+ZOO_KEYWORDS = frozenset(["зоопарк","ньиредьхаза","nyire","лев","одноден","мукач","ужгород"])
+CAMP_MENTION_KEYWORDS = frozenset(["лагерь", "лапландія", "карпат", "зимовий"])
+ZOO_MENTION_KEYWORDS = frozenset(["зоопарк", "ньиредьхаза", "ньиредьгаза"])
+OBJECTION_KEYWORDS = frozenset(["передума", "не хочу", "не потрібно", "ні", "нет", "не нужно"])
+PAY_KEYWORDS = frozenset(["приват","моно","оплат","готов","давайте","скинь","реквізит"])
+PAID_KEYWORDS = frozenset(["оплат","відправ","готово","скинув","чек"])
+BOOKING_KEYWORDS = frozenset(["брон"])
+CHILD_KEYWORDS = frozenset(["дит"])
+DETAILS_KEYWORDS = frozenset(["детал"])
+COST_KEYWORDS = frozenset(["варт","цін"])
+TELL_MORE_KEYWORDS = frozenset(["так","добре","розкажіть"])
+
+def keyword_regex(keywords:frozenset):
+    """Компилирует набор подстрок в одну регулярку-альтернацию (поиск за один проход)"""
+    return re.compile("|".join(map(re.escape, sorted(keywords))), re.IGNORECASE)
+
+def intent_regex(keywords:frozenset):
+    """Как keyword_regex, но по границам слов; для основ из INTENT_STEMS — только по началу слова"""
+    parts = (re.escape(k) if k in INTENT_STEMS else rf"{re.escape(k)}\b" for k in sorted(keywords))
+    return re.compile(rf"\b(?:{'|'.join(parts)})", re.IGNORECASE)
+
+POSITIVE_RE = intent_regex(POSITIVE_KEYWORDS)
+NEGATIVE_RE = intent_regex(NEGATIVE_KEYWORDS)
+CAMP_RE = keyword_regex(CAMP_KEYWORDS)
+ZOO_RE = keyword_regex(ZOO_KEYWORDS)
+PAY_RE = keyword_regex(PAY_KEYWORDS)
+PAID_RE = keyword_regex(PAID_KEYWORDS)
+CAMP_MENTION_RE = keyword_regex(CAMP_MENTION_KEYWORDS)
+ZOO_MENTION_RE = keyword_regex(ZOO_MENTION_KEYWORDS)
+OBJECTION_RE = intent_regex(OBJECTION_KEYWORDS)
+BOOKING_RE = keyword_regex(BOOKING_KEYWORDS)
+CHILD_RE = keyword_regex(CHILD_KEYWORDS)
+DETAILS_RE = keyword_regex(DETAILS_KEYWORDS)
+COST_RE = keyword_regex(COST_KEYWORDS)
+TELL_MORE_RE = keyword_regex(TELL_MORE_KEYWORDS)
+# Однословные ключевые слова: слово -> намерение, строится один раз при импорте
+INTENT_WORDS = {
+    **{k: "positive" for k in POSITIVE_KEYWORDS if " " not in k and k not in INTENT_STEMS},
+    **{k: "negative" for k in NEGATIVE_KEYWORDS if " " not in k and k not in INTENT_STEMS},
+}
+# Фразы и основы: их не найти поиском по таблице, поэтому — регулярками
+INTENT_PATTERNS = {
+    **{k: "positive" for k in POSITIVE_KEYWORDS if k not in INTENT_WORDS},
+    **{k: "negative" for k in NEGATIVE_KEYWORDS if k not in INTENT_WORDS},
+}
+INTENT_PHRASE_RE = intent_regex(frozenset(k for k in INTENT_PATTERNS if " " in k))
+INTENT_STEM_RE = intent_regex(frozenset(k for k in INTENT_PATTERNS if k in INTENT_STEMS))
+WORD_RE = re.compile(r"\w+")
+# Номер телефона: необязательный "+", затем цифры с пробелами, дефисами, скобками и точками
+PHONE_RE = re.compile(r"^\+?[\d\s().\-]{7,20}$")
+
 def is_positive_response(txt:str)->bool:
-    arr = ["так","добре","да","ок","продовжуємо","розкажіть","готовий","готова","привіт","hello","yes","зацікав","sure"]
-    return any(k in txt.lower() for k in arr)
+    return POSITIVE_RE.search(txt) is not None
 
 def is_negative_response(txt:str)->bool:
-    arr = ["не хочу","не можу","нет","ні","не буду","не зараз","no"]
-    return any(k in txt.lower() for k in arr)
+    return NEGATIVE_RE.search(txt) is not None
 
 def analyze_intent(txt:str)->str:
-    if nlp_uk:
-        doc = nlp_uk(txt)
-        lemmas = [t.lemma_.lower() for t in doc]
-        if any(k in lemmas for k in ["так","ок","добре","готовий"]):
-            return "positive"
-        if any(k in lemmas for k in ["не","ні","нет","небуду"]):
-            return "negative"
-        return "unclear"
-    else:
-        if is_positive_response(txt):
-            return "positive"
-        elif is_negative_response(txt):
-            return "negative"
-        else:
-            return "unclear"
+    # Фразы конкретнее отдельных слов ("не хочу", "no problem"), затем целые слова —
+    # прямой поиск в таблице, и только потом основы ("зацікав")
+    m = INTENT_PHRASE_RE.search(txt)
+    if m:
+        return INTENT_PATTERNS[m.group().lower()]
+    for token in WORD_RE.findall(txt.lower()):
+        intent = INTENT_WORDS.get(token)
+        if intent:
+            return intent
+    m = INTENT_STEM_RE.search(txt)
+    return INTENT_PATTERNS[m.group().lower()] if m else "unclear"
+
+# ============================
+# Scenario embeddings
+# ============================
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Эмбеддинг — лишь ускорение перед GPT; долго ждать его нет смысла
+EMBEDDING_TIMEOUT_SECONDS = 5
+SCENARIO_MATCH_THRESHOLD = 0.55
+SCENARIO_FALLBACK_THRESHOLD = 0.4
+
+SCENARIO_SAMPLES = {
+    "camp": ["зимовий табір у Карпатах", "лапландія", "сніг", "гори дитячий табір"],
+    "zoo": ["зоопарк Ньїредьгаза", "одноденний тур в Угорщину", "екзотичні тварини", "автобусна екскурсія"],
+}
+
+# Центроиды эмбеддингов сценариев, считаются один раз при первом обращении
+scenario_centroids = None
+
+async def embed_texts(texts: list) -> list:
+    """Возвращает эмбеддинги текстов через OpenAI"""
+    use_openai_session()
+    response = await openai.Embedding.acreate(
+        model=EMBEDDING_MODEL, input=texts, request_timeout=EMBEDDING_TIMEOUT_SECONDS
+    )
+    return [item["embedding"] for item in response["data"]]
+
+def cosine_similarity(a: list, b: list) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+async def detect_scenario_by_embedding(txt: str):
+    """Определяет сценарий ("camp"/"zoo") по близости к эталонным фразам, None — если неясно"""
+    global scenario_centroids
+    if not (openai and OPENAI_API_KEY):
+        return None
+    try:
+        if scenario_centroids is None:
+            names = list(SCENARIO_SAMPLES)
+            vectors = await embed_texts([t for name in names for t in SCENARIO_SAMPLES[name]])
+            centroids = {}
+            pos = 0
+            for name in names:
+                group = vectors[pos:pos + len(SCENARIO_SAMPLES[name])]
+                pos += len(group)
+                centroids[name] = [sum(col) / len(group) for col in zip(*group)]
+            scenario_centroids = centroids
+        vector = (await embed_texts([txt]))[0]
+    except Exception as e:
+        logger.error(f"Ошибка при получении эмбеддингов: {e}")
+        return None
+
+    scores = {name: cosine_similarity(vector, c) for name, c in scenario_centroids.items()}
+    best = max(scores, key=scores.get)
+    if scores[best] > SCENARIO_MATCH_THRESHOLD:
+        return best
+    # В промежуточной зоне выбираем сценарий, только если второй явно не подходит
+    if scores[best] >= SCENARIO_FALLBACK_THRESHOLD and all(
+        score < SCENARIO_FALLBACK_THRESHOLD for name, score in scores.items() if name != best
+    ):
+        return best
+    return None
 
 # ============================
 # GPT fallback
 # ============================
+GPT_CACHE_SIZE = 1024
+GPT_TIMEOUT_SECONDS = 30
+# Не больше стольких одновременных запросов к ChatCompletion (у сессии OpenAI 20 соединений)
+GPT_MAX_CONCURRENCY = 16
+
+# Точный кэш ответов: (стадия, сценарий, хэш истории, хэш нормализованного текста) -> ответ (LRU)
+gpt_cache = OrderedDict()
+# Запросы, которые сейчас в работе: дайджест промпта и сообщения -> задача.
+# Один вызов OpenAI делят только запросы с одинаковым промптом
+gpt_inflight = {}
+gpt_semaphore = asyncio.Semaphore(GPT_MAX_CONCURRENCY)
+
+def find_cached_gpt_reply(cache_key: tuple):
+    cached = gpt_cache.get(cache_key)
+    if cached is not None:
+        gpt_cache.move_to_end(cache_key)
+    return cached
+
+def remember_gpt_reply(cache_key: tuple, reply: str) -> None:
+    gpt_cache[cache_key] = reply
+    if len(gpt_cache) > GPT_CACHE_SIZE:
+        gpt_cache.popitem(last=False)
+
 async def gpt_fallback_response(message: str, context: CallbackContext) -> str:
     """Генерирует ответ с помощью GPT с учетом контекста и стадии разговора"""
     current_stage = context.user_data.get("current_stage", STAGE_SCENARIO_CHOICE)
     user_data = context.user_data
     scenario = user_data.get("scenario", "")
+    history = "\n".join(
+        f"{role}: {content}"
+        for role, content in zip(user_data.get("hist_roles", []), user_data.get("hist_texts", []))
+    )
     
     # Формируем контекст для GPT
     prompt = f"""Ты - опытный продавец-консультант туристической компании с глубоким пониманием психологии продаж.
 Текущая стадия разговора: {current_stage}
 Сценарий: {scenario}
-История сообщений: {user_data.get('message_history', [])}
+История сообщений:
+{history}
 Последнее сообщение пользователя: {message}
 
 Информация о турах:
@@ -384,17 +738,42 @@ async def gpt_fallback_response(message: str, context: CallbackContext) -> str:
 
 Сгенерируй ответ, который поможет продвинуть продажу дальше."""
 
+    # Тот же вопрос в том же состоянии диалога отдаём из кэша.
+    # История (телефон, город, дети, прошлые реплики) входит в ключ: ответ, написанный
+    # для одного пользователя, другому не уходит.
+    # Вместо самих текстов (бывают целым промптом) в ключе 16-байтные дайджесты
+    history_digest = hashlib.blake2b(history.encode(), digest_size=16).digest()
+    text_digest = hashlib.blake2b(message.strip().casefold().encode(), digest_size=16).digest()
+    cache_key = (current_stage, scenario, history_digest, text_digest)
+    cached = find_cached_gpt_reply(cache_key)
+    if cached is not None:
+        return cached
+    # Точно такой же запрос уже ушёл в OpenAI — ждём его ответ, а не шлём второй
+    request_key = hashlib.blake2b(f"{prompt}\0{message}".encode(), digest_size=16).digest()
+    pending = gpt_inflight.get(request_key)
+    if pending is None:
+        pending = asyncio.create_task(generate_gpt_reply(prompt, message, cache_key))
+        gpt_inflight[request_key] = pending
+        pending.add_done_callback(lambda _: gpt_inflight.pop(request_key, None))
+    return await asyncio.shield(pending)
+
+async def generate_gpt_reply(prompt: str, message: str, cache_key: tuple) -> str:
     try:
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": message}
-            ],
-            temperature=0.7,
-            max_tokens=500
-        )
-        return response.choices[0].message.content
+        use_openai_session()
+        async with gpt_semaphore:
+            response = await openai.ChatCompletion.acreate(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": message}
+                ],
+                temperature=0.7,
+                max_tokens=500,
+                request_timeout=GPT_TIMEOUT_SECONDS
+            )
+        reply = response.choices[0].message.content
+        remember_gpt_reply(cache_key, reply)
+        return reply
     except Exception as e:
         logger.error(f"Ошибка при генерации ответа GPT: {e}")
         return "Извините, произошла ошибка. Пожалуйста, попробуйте еще раз."
@@ -402,47 +781,73 @@ async def gpt_fallback_response(message: str, context: CallbackContext) -> str:
 # ============================
 # START Handler
 # ============================
+# update_id сообщений, на которые уже ответил ConversationHandler (group=0)
+conversation_updates = set()
+
+# Стадии, где уверенно распознанное намерение получает ответ скрипта без обращения к GPT:
+# стадия -> намерение -> (ответ, следующая стадия)
+SCRIPTED_INTENT_REPLIES = {
+    STAGE_CAMP_DETAILED: {
+        "positive": (LAPLANDIA_BRIEF, STAGE_CAMP_END),
+        "negative": ("Добре! 😊 Якщо виникнуть питання — звертайтесь! ✨", STAGE_CAMP_END),
+    },
+    STAGE_ZOO_QUESTIONS: {
+        "positive": (
+            "Чудово! Чи готові ви до бронювання? Вам зручніше оплатити через ПриватБанк чи MonoBank?",
+            STAGE_ZOO_CLOSE_DEAL,
+        ),
+        "negative": ("Шкода це чути. Якщо будуть питання — я завжди тут!", STAGE_ZOO_END),
+    },
+}
+
 async def message_handler(update: Update, context: CallbackContext) -> int:
     """Обработчик всех текстовых сообщений"""
-    user_id = str(update.effective_user.id)
+    user_id = uid(update)
+    chat_id = update.effective_chat.id
     user_text = update.message.text.strip()
+    # Группы обходятся по очереди: global_fallback_handler в group=1 увидит, что ответ уже дан
+    conversation_updates.add(update.update_id)
     
     # Получаем текущее состояние
     current_stage = context.user_data.get("current_stage", STAGE_SCENARIO_CHOICE)
     
     # Определяем сценарий, если еще не определен
     if current_stage == STAGE_SCENARIO_CHOICE:
-        if any(k in user_text.lower() for k in ["лагерь", "лапландія", "карпат", "зимовий"]):
+        if CAMP_MENTION_RE.search(user_text):
             context.user_data["scenario"] = "camp"
-        elif any(k in user_text.lower() for k in ["зоопарк", "ньиредьхаза", "ньиредьгаза"]):
+        elif ZOO_MENTION_RE.search(user_text):
             context.user_data["scenario"] = "zoo"
+        else:
+            # Перефразированный запрос ("гори", "Угорщина") пробуем распознать по эмбеддингам
+            scenario = await detect_scenario_by_embedding(user_text)
+            if scenario:
+                context.user_data["scenario"] = scenario
     
     # Проверяем на отказ или возражение
-    if any(k in user_text.lower() for k in ["передумав", "не хочу", "не потрібно", "ні", "нет", "не нужно"]):
+    if OBJECTION_RE.search(user_text):
         # Сохраняем информацию об отказе
         context.user_data["last_objection"] = user_text
         # Не меняем стадию, чтобы GPT мог поработать с возражением
         next_stage = current_stage
     else:
         # Сохраняем сообщение в историю
-        message_history = context.user_data.get("message_history", [])
-        message_history.append({"role": "user", "content": user_text})
-        context.user_data["message_history"] = message_history
+        append_history(context.user_data, "user", user_text)
     
     # Отменяем предыдущий таймер
-    if "no_response_job" in context.user_data:
-        context.user_data["no_response_job"].schedule_removal()
+    cancel_no_response_job(context)
     
-    # Получаем ответ от GPT
-    response = await gpt_fallback_response(user_text, context)
+    # Бронирование ведёт обычный переход; иначе уверенное "да"/"нет" обходится без GPT
+    scripted = None
+    if current_stage in SCRIPTED_INTENT_REPLIES and not BOOKING_RE.search(user_text):
+        scripted = SCRIPTED_INTENT_REPLIES[current_stage].get(analyze_intent(user_text))
+    if scripted:
+        response = scripted[0]
+    else:
+        # Получаем ответ от GPT
+        response = await gpt_fallback_response(user_text, context)
     
     # Сохраняем ответ в историю
-    message_history = context.user_data.get("message_history", [])
-    message_history.append({"role": "assistant", "content": response})
-    context.user_data["message_history"] = message_history
-    
-    # Отправляем ответ с симуляцией набора
-    await typing_simulation(update, response)
+    append_history(context.user_data, "assistant", response)
     
     # Определяем следующее состояние на основе сценария
     next_stage = current_stage
@@ -466,7 +871,7 @@ async def message_handler(update: Update, context: CallbackContext) -> int:
         elif current_stage == STAGE_CAMP_CHILDREN:
             next_stage = STAGE_CAMP_DETAILED
         elif current_stage == STAGE_CAMP_DETAILED:
-            if "брон" in user_text.lower():
+            if BOOKING_RE.search(user_text):
                 next_stage = STAGE_CAMP_PHONE
             else:
                 next_stage = STAGE_CAMP_END
@@ -482,21 +887,21 @@ async def message_handler(update: Update, context: CallbackContext) -> int:
         elif current_stage == STAGE_ZOO_DEPARTURE:
             next_stage = STAGE_ZOO_TRAVEL_PARTY
         elif current_stage == STAGE_ZOO_TRAVEL_PARTY:
-            if "дит" in user_text.lower():
+            if CHILD_RE.search(user_text):
                 next_stage = STAGE_ZOO_CHILD_AGE
             else:
                 next_stage = STAGE_ZOO_CHOICE
         elif current_stage == STAGE_ZOO_CHILD_AGE:
             next_stage = STAGE_ZOO_CHOICE
         elif current_stage == STAGE_ZOO_CHOICE:
-            if "брон" in user_text.lower():
+            if BOOKING_RE.search(user_text):
                 next_stage = STAGE_ZOO_CLOSE_DEAL
             else:
                 next_stage = STAGE_ZOO_DETAILS
         elif current_stage == STAGE_ZOO_DETAILS:
             next_stage = STAGE_ZOO_QUESTIONS
         elif current_stage == STAGE_ZOO_QUESTIONS:
-            if "брон" in user_text.lower():
+            if BOOKING_RE.search(user_text):
                 next_stage = STAGE_ZOO_CLOSE_DEAL
             else:
                 next_stage = STAGE_ZOO_IMPRESSION
@@ -506,35 +911,43 @@ async def message_handler(update: Update, context: CallbackContext) -> int:
             else:
                 next_stage = STAGE_ZOO_END
         elif current_stage == STAGE_ZOO_CLOSE_DEAL:
-            if any(k in user_text.lower() for k in ["приват", "моно", "оплат", "готов", "давайте", "скинь", "реквізит"]):
+            if PAY_RE.search(user_text):
                 next_stage = STAGE_ZOO_PAYMENT
             else:
                 next_stage = STAGE_ZOO_END
         elif current_stage == STAGE_ZOO_PAYMENT:
-            if any(k in user_text.lower() for k in ["оплат", "відправ", "готово", "скинув", "чек"]):
+            if PAID_RE.search(user_text):
                 next_stage = STAGE_ZOO_PAYMENT_CONFIRM
             else:
                 next_stage = STAGE_ZOO_PAYMENT
         elif current_stage == STAGE_ZOO_PAYMENT_CONFIRM:
             next_stage = STAGE_ZOO_END
     
-    # Сохраняем состояние пользователя
+    if scripted:
+        next_stage = scripted[1]
+    
+    # Сохраняем состояние пользователя; стадию читают message_handler и gpt_fallback_response
+    context.user_data["current_stage"] = next_stage
     save_user_state(user_id, next_stage, context.user_data)
     
     # Планируем таймер для отсутствия ответа
-    context.user_data["no_response_job"] = context.job_queue.run_once(
-        no_response_callback, 300, data={"user_id": user_id}
-    )
+    schedule_no_response_job(context, chat_id, QUICK_NO_RESPONSE_DELAY_SECONDS)
+    
+    # Отправляем ответ с симуляцией набора
+    await typing_simulation(update, response)
     
     return next_stage
 
 async def start_command(update: Update, context: CallbackContext) -> int:
     """Обработчик команды /start"""
-    user_id = str(update.effective_user.id)
+    user_id = uid(update)
+    chat_id = update.effective_chat.id
     
     # Очищаем историю предыдущего разговора
     context.user_data.clear()
-    context.user_data["message_history"] = []
+    context.user_data["hist_roles"] = []
+    context.user_data["hist_texts"] = []
+    context.user_data["current_stage"] = STAGE_SCENARIO_CHOICE
     
     # Формируем приветственное сообщение
     welcome_message = """Привіт! 👋 Я Олена, ваш персональний асистент з вибору дитячого відпочинку.
@@ -555,44 +968,43 @@ async def start_command(update: Update, context: CallbackContext) -> int:
 
 Що вас цікавить? 😊"""
     
-    # Отправляем приветственное сообщение
-    await typing_simulation(update, welcome_message)
-    
     # Сохраняем начальное состояние
     save_user_state(user_id, STAGE_SCENARIO_CHOICE, context.user_data)
     
     # Планируем таймер для отсутствия ответа
-    context.user_data["no_response_job"] = context.job_queue.run_once(
-        no_response_callback, 300, data={"user_id": user_id}
-    )
+    schedule_no_response_job(context, chat_id, QUICK_NO_RESPONSE_DELAY_SECONDS)
+    
+    # Отправляем приветственное сообщение
+    await typing_simulation(update, welcome_message)
     
     return STAGE_SCENARIO_CHOICE
 
 # ============================
 # SCENARIO CHOICE
 # ============================
+@resets_no_response
 async def scenario_choice_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
-    txt = update.message.text.lower().strip()
+    txt = update.message.text.strip()
+
+    if CAMP_RE.search(txt):
+        scenario = "camp"
+    elif ZOO_RE.search(txt):
+        scenario = "zoo"
+    else:
+        # Перефразированный запрос ("гори", "Угорщина") пробуем распознать по эмбеддингам
+        scenario = await detect_scenario_by_embedding(txt)
 
     # Лагерь
-    if any(k in txt for k in ["лапланд","карпат","лагерь","camp"]):
+    if scenario == "camp":
         context.user_data["scenario"] = "camp"
         text = LAPLANDIA_INTRO
-        await typing_simulation(update, text)
-        save_user_state(user_id, STAGE_CAMP_PHONE, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_CAMP_PHONE
+        return await transition(update, context, text, STAGE_CAMP_PHONE)
 
     # Зоопарк
-    elif any(k in txt for k in ["зоопарк","ньиредьхаза","nyire","лев","одноден","мукач","ужгород"]):
+    elif scenario == "zoo":
         context.user_data["scenario"] = "zoo"
         text = ZOO_INTRO
-        await typing_simulation(update, text)
-        save_user_state(user_id, STAGE_ZOO_GREET, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_GREET
+        return await transition(update, context, text, STAGE_ZOO_GREET)
 
     else:
         # GPT fallback с контекстом
@@ -602,48 +1014,36 @@ async def scenario_choice_handler(update:Update, context:ContextTypes.DEFAULT_TY
             "Если непонятно, попроси уточнить."
         )
         gpt_text = await gpt_fallback_response(prompt, context)
-        await typing_simulation(update, gpt_text)
-        save_user_state(user_id, STAGE_SCENARIO_CHOICE, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_SCENARIO_CHOICE
+        return await transition(update, context, gpt_text, STAGE_SCENARIO_CHOICE)
 
 # ============================
 # CAMP: PHONE
 # ============================
+@resets_no_response
 async def camp_phone_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
     txt = update.message.text.strip()
 
     # Проверяем, не обработали ли мы уже это сообщение
     if context.user_data.get("phone_processed"):
         return STAGE_CAMP_PHONE
 
-    phone_candidate = txt.replace(" ","").replace("-","")
-    if phone_candidate.startswith("+") or phone_candidate.isdigit():
+    if PHONE_RE.match(txt):
         # пользователь дал телефон
-        context.user_data["phone"] = phone_candidate
+        context.user_data["phone"] = txt
         context.user_data["phone_processed"] = True
         r = "Дякую! 📲 Передаю ваш номер нашому менеджеру. Вона зв'яжеться з вами найближчим часом. ✨"
-        await typing_simulation(update, r)
-        save_user_state(user_id, STAGE_CAMP_DETAILED, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_CAMP_DETAILED
+        return await transition(update, context, r, STAGE_CAMP_DETAILED)
     else:
         # не дал телефон
         context.user_data["phone_processed"] = True
         r = "Зрозуміло! 😊 Тоді давайте я розповім вам про табір прямо тут. Хочете дізнатися деталі? 🤔"
-        await typing_simulation(update, r)
-        save_user_state(user_id, STAGE_CAMP_NO_PHONE_QA, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_CAMP_NO_PHONE_QA
+        return await transition(update, context, r, STAGE_CAMP_NO_PHONE_QA)
 
 # ============================
 # CAMP: NO PHONE Q/A
 # ============================
+@resets_no_response
 async def camp_no_phone_qa_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
     txt = update.message.text.strip()
 
     # Проверяем, не обработали ли мы уже это сообщение
@@ -655,22 +1055,16 @@ async def camp_no_phone_qa_handler(update:Update, context:ContextTypes.DEFAULT_T
     
     if intent == "positive":
         r = "Чудово! 🎉 З якого ви міста? 🏙️"
-        await typing_simulation(update, r)
-        save_user_state(user_id, STAGE_CAMP_CITY, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_CAMP_CITY
+        return await transition(update, context, r, STAGE_CAMP_CITY)
     else:
         r = "Добре! 😊 Якщо виникнуть питання — звертайтесь! ✨"
-        await typing_simulation(update, r)
-        save_user_state(user_id, STAGE_CAMP_END, context.user_data)
-        return STAGE_CAMP_END
+        return await transition(update, context, r, STAGE_CAMP_END, schedule=False)
 
 # ============================
 # CAMP: CITY
 # ============================
+@resets_no_response
 async def camp_city_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
     txt = update.message.text.strip()
 
     # Проверяем, не обработали ли мы уже это сообщение
@@ -681,17 +1075,13 @@ async def camp_city_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
     context.user_data["city"] = txt
     
     r = f"Чудово! 🎉 А скільки дітей плануєте відправити? 👶"
-    await typing_simulation(update, r)
-    save_user_state(user_id, STAGE_CAMP_CHILDREN, context.user_data)
-    schedule_no_response_job(context, update.effective_chat.id)
-    return STAGE_CAMP_CHILDREN
+    return await transition(update, context, r, STAGE_CAMP_CHILDREN)
 
 # ============================
 # CAMP: CHILDREN
 # ============================
+@resets_no_response
 async def camp_children_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
     txt = update.message.text.strip()
 
     # Проверяем, не обработали ли мы уже это сообщение
@@ -702,16 +1092,13 @@ async def camp_children_handler(update:Update, context:ContextTypes.DEFAULT_TYPE
     context.user_data["children"] = txt
 
     r = LAPLANDIA_BRIEF
-    await typing_simulation(update, r)
-    save_user_state(user_id, STAGE_CAMP_END, context.user_data)
-    return STAGE_CAMP_END
+    return await transition(update, context, r, STAGE_CAMP_END, schedule=False)
 
 # ============================
 # CAMP: DETAILED
 # ============================
+@resets_no_response
 async def camp_detailed_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
     txt = update.message.text.strip()
 
     # Проверяем, не обработали ли мы уже это сообщение
@@ -721,19 +1108,23 @@ async def camp_detailed_handler(update:Update, context:ContextTypes.DEFAULT_TYPE
     context.user_data["detailed_processed"] = True
 
     # Проверяем, не является ли сообщение ответом на вопрос о деталях
-    if "так" in txt.lower() or "добре" in txt.lower() or "розкажіть" in txt.lower():
+    if TELL_MORE_RE.search(txt):
         r = LAPLANDIA_BRIEF
-        await typing_simulation(update, r)
-        save_user_state(user_id, STAGE_CAMP_END, context.user_data)
-        return STAGE_CAMP_END
-    elif "брон" in txt.lower() or "заброн" in txt.lower():
+        return await transition(update, context, r, STAGE_CAMP_END, schedule=False)
+    elif BOOKING_RE.search(txt):
         r = "Чудово! 🎉 Для бронювання нам потрібен ваш номер телефону. Наш менеджер зв'яжеться з вами найближчим часом. 📞"
-        await typing_simulation(update, r)
-        save_user_state(user_id, STAGE_CAMP_PHONE, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_CAMP_PHONE
+        return await transition(update, context, r, STAGE_CAMP_PHONE)
+
+    # Уверенно распознанное намерение обрабатываем без обращения к GPT
+    intent = analyze_intent(txt)
+    if intent == "positive":
+        r = LAPLANDIA_BRIEF
+        return await transition(update, context, r, STAGE_CAMP_END, schedule=False)
+    elif intent == "negative":
+        r = "Добре! 😊 Якщо виникнуть питання — звертайтесь! ✨"
+        return await transition(update, context, r, STAGE_CAMP_END, schedule=False)
     else:
-        # Если это не ответ на вопрос о деталях, используем GPT
+        # GPT только если намерение не распознано
         prompt = (
             f"Клієнт написав: {txt}\n"
             "Контекст: Клієнт зацікавлений зимовим табором 'Лапландія в Карпатах'. "
@@ -742,16 +1133,13 @@ async def camp_detailed_handler(update:Update, context:ContextTypes.DEFAULT_TYPE
             "з емодзі та чіткими пунктами."
         )
         gpt_text = await gpt_fallback_response(prompt, context)
-        await typing_simulation(update, gpt_text)
-        save_user_state(user_id, STAGE_CAMP_DETAILED, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_CAMP_DETAILED
+        return await transition(update, context, gpt_text, STAGE_CAMP_DETAILED)
 
 # ============================
 # CAMP: END
 # ============================
+@resets_no_response
 async def camp_end_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
     r = "Дякую за спілкування! ✨ Якщо виникнуть питання — /start. Гарного дня! 🌟"
     await typing_simulation(update, r)
     return ConversationHandler.END
@@ -759,27 +1147,20 @@ async def camp_end_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
 # ============================
 # ZOO: Greet
 # ============================
+@resets_no_response
 async def zoo_greet_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
     txt = update.message.text.strip()
 
     intent = analyze_intent(txt)
     if intent == "positive":
         r = "Звідки вам зручніше виїжджати: з Ужгорода чи Мукачева? 🚌"
-        await typing_simulation(update, r)
-        save_user_state(user_id, STAGE_ZOO_DEPARTURE, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_DEPARTURE
+        return await transition(update, context, r, STAGE_ZOO_DEPARTURE)
     elif intent == "negative":
         msg = (
             "Я можу коротко розповісти про наш одноденний тур, якщо вам незручно відповідати на питання. "
             "Це займе буквально хвилину!"
         )
-        await typing_simulation(update, msg)
-        save_user_state(user_id, STAGE_ZOO_DETAILS, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_DETAILS
+        return await transition(update, context, msg, STAGE_ZOO_DETAILS)
     else:
         prompt = (
             f"Клієнт написав: {txt}\n"
@@ -789,55 +1170,43 @@ async def zoo_greet_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
         await typing_simulation(update, fallback)
         return STAGE_ZOO_GREET
 
+@resets_no_response
 async def zoo_departure_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    user_id = str(update.effective_user.id)
     txt = update.message.text.strip()
 
     context.user_data["departure"] = txt
     r = "Для кого ви розглядаєте цю поїздку? Плануєте їхати разом з дитиною?"
-    await typing_simulation(update, r)
-    save_user_state(user_id, STAGE_ZOO_TRAVEL_PARTY, context.user_data)
-    schedule_no_response_job(context, update.effective_chat.id)
-    return STAGE_ZOO_TRAVEL_PARTY
+    return await transition(update, context, r, STAGE_ZOO_TRAVEL_PARTY)
 
+@resets_no_response
 async def zoo_travel_party_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    txt = update.message.text.lower().strip()
+    txt = update.message.text.strip()
 
-    if "дит" in txt:
-        await typing_simulation(update, "Скільки років вашій дитині?")
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CHILD_AGE, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_CHILD_AGE
+    if CHILD_RE.search(txt):
+        return await transition(update, context, "Скільки років вашій дитині?", STAGE_ZOO_CHILD_AGE)
     else:
         r = "Що вас цікавить найбільше: деталі туру, вартість чи бронювання місця? 😊"
-        await typing_simulation(update, r)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CHOICE, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_CHOICE
+        return await transition(update, context, r, STAGE_ZOO_CHOICE)
 
+@resets_no_response
 async def zoo_child_age_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
     r = "Що вас цікавить найбільше: деталі туру, вартість чи бронювання місця? 😊"
-    await typing_simulation(update, r)
-    save_user_state(str(update.effective_user.id), STAGE_ZOO_CHOICE, context.user_data)
-    schedule_no_response_job(context, update.effective_chat.id)
-    return STAGE_ZOO_CHOICE
+    return await transition(update, context, r, STAGE_ZOO_CHOICE)
 
+@resets_no_response
 async def zoo_choice_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    txt = update.message.text.lower().strip()
+    user_id = uid(update)
+    txt = update.message.text.strip()
 
-    if "детал" in txt:
+    if DETAILS_RE.search(txt):
         context.user_data["choice"] = "details"
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_DETAILS, context.user_data)
+        save_user_state(user_id, STAGE_ZOO_DETAILS, context.user_data)
         return await zoo_details_handler(update, context)
-    elif "варт" in txt or "цін" in txt:
+    elif COST_RE.search(txt):
         context.user_data["choice"] = "cost"
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_DETAILS, context.user_data)
+        save_user_state(user_id, STAGE_ZOO_DETAILS, context.user_data)
         return await zoo_details_handler(update, context)
-    elif "брон" in txt:
+    elif BOOKING_RE.search(txt):
         context.user_data["choice"] = "booking"
         r = (
             "Я дуже рада, що ви обрали подорож з нами. "
@@ -845,20 +1214,14 @@ async def zoo_choice_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
             "Для цього потрібно внести аванс 30% та надіслати фото паспорта. "
             "Вам зручніше оплатити через ПриватБанк чи MonoBank?"
         )
-        await typing_simulation(update, r)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CLOSE_DEAL, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_CLOSE_DEAL
+        return await transition(update, context, r, STAGE_ZOO_CLOSE_DEAL)
     else:
         resp = "Будь ласка, уточніть: вас цікавлять деталі туру, вартість чи бронювання місця?"
-        await typing_simulation(update, resp)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CHOICE, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_CHOICE
+        return await transition(update, context, resp, STAGE_ZOO_CHOICE)
 
+@resets_no_response
 async def zoo_details_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    txt = update.message.text.lower()
+    txt = update.message.text.strip()
 
     # Проверяем, не обработали ли мы уже это сообщение
     if context.user_data.get("zoo_details_processed"):
@@ -879,14 +1242,11 @@ async def zoo_details_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
     else:
         text = ZOO_DETAILS
 
-    await typing_simulation(update, text)
-    save_user_state(str(update.effective_user.id), STAGE_ZOO_QUESTIONS, context.user_data)
-    schedule_no_response_job(context, update.effective_chat.id)
-    return STAGE_ZOO_QUESTIONS
+    return await transition(update, context, text, STAGE_ZOO_QUESTIONS)
 
+@resets_no_response
 async def zoo_questions_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    txt = update.message.text.lower()
+    txt = update.message.text.strip()
 
     # Проверяем, не обработали ли мы уже это сообщение
     if context.user_data.get("zoo_questions_processed"):
@@ -894,11 +1254,18 @@ async def zoo_questions_handler(update:Update, context:ContextTypes.DEFAULT_TYPE
 
     context.user_data["zoo_questions_processed"] = True
 
-    if "брон" in txt:
+    if BOOKING_RE.search(txt):
         r = "Чудово, тоді переходимо до оформлення бронювання. Я надішлю реквізити для оплати!"
-        await typing_simulation(update, r)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CLOSE_DEAL, context.user_data)
-        return STAGE_ZOO_CLOSE_DEAL
+        return await transition(update, context, r, STAGE_ZOO_CLOSE_DEAL, schedule=False)
+
+    # Уверенно распознанное намерение обрабатываем без обращения к GPT
+    intent = analyze_intent(txt)
+    if intent == "positive":
+        r = "Чудово! Чи готові ви до бронювання? Вам зручніше оплатити через ПриватБанк чи MonoBank?"
+        return await transition(update, context, r, STAGE_ZOO_CLOSE_DEAL)
+    elif intent == "negative":
+        r = "Шкода це чути. Якщо будуть питання — я завжди тут!"
+        return await transition(update, context, r, STAGE_ZOO_END, schedule=False)
     else:
         # Используем GPT для нестандартных вопросов
         prompt = (
@@ -908,14 +1275,11 @@ async def zoo_questions_handler(update:Update, context:ContextTypes.DEFAULT_TYPE
             "зберігаючи дружній тон та структуру відповіді."
         )
         gpt_text = await gpt_fallback_response(prompt, context)
-        await typing_simulation(update, gpt_text)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_QUESTIONS, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_QUESTIONS
+        return await transition(update, context, gpt_text, STAGE_ZOO_QUESTIONS)
 
+@resets_no_response
 async def zoo_impression_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    txt = update.message.text.lower()
+    txt = update.message.text.strip()
 
     if is_positive_response(txt):
         r = (
@@ -923,67 +1287,45 @@ async def zoo_impression_handler(update:Update, context:ContextTypes.DEFAULT_TYP
             "Потрібно внести аванс 30% та надіслати фото паспорта. "
             "Вам зручніше оплатити через ПриватБанк чи MonoBank?"
         )
-        await typing_simulation(update, r)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CLOSE_DEAL, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_CLOSE_DEAL
+        return await transition(update, context, r, STAGE_ZOO_CLOSE_DEAL)
     elif is_negative_response(txt):
         rr = "Шкода це чути. Якщо будуть питання — я завжди тут!"
-        await typing_simulation(update, rr)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_END, context.user_data)
-        return STAGE_ZOO_END
+        return await transition(update, context, rr, STAGE_ZOO_END, schedule=False)
     else:
         fallback = "Дякую за думку! Чи готові ви до бронювання?"
-        await typing_simulation(update, fallback)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CLOSE_DEAL, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_CLOSE_DEAL
+        return await transition(update, context, fallback, STAGE_ZOO_CLOSE_DEAL)
 
+@resets_no_response
 async def zoo_close_deal_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    txt = update.message.text.lower()
+    txt = update.message.text.strip()
 
-    if any(k in txt for k in ["приват","моно","оплат","готов","давайте","скинь","реквізит"]):
+    if PAY_RE.search(txt):
         r = (
             "Чудово! Ось реквізити:\n"
             "Картка: 0000 0000 0000 0000\n\n"
             "Як оплатите — надішліть, будь ласка, скрін. Після цього я надішлю програму та підтвердження бронювання!"
         )
-        await typing_simulation(update, r)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_PAYMENT, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_PAYMENT
+        return await transition(update, context, r, STAGE_ZOO_PAYMENT)
     elif is_negative_response(txt):
         r2 = "Зрозуміло. Буду рада допомогти, якщо передумаєте!"
-        await typing_simulation(update, r2)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_END, context.user_data)
-        return STAGE_ZOO_END
+        return await transition(update, context, r2, STAGE_ZOO_END, schedule=False)
     else:
         r3 = "Ви готові завершити оформлення? Вам зручніше оплатити через ПриватБанк чи MonoBank?"
-        await typing_simulation(update, r3)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_CLOSE_DEAL, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_CLOSE_DEAL
+        return await transition(update, context, r3, STAGE_ZOO_CLOSE_DEAL)
 
+@resets_no_response
 async def zoo_payment_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
-    txt = update.message.text.lower()
+    txt = update.message.text.strip()
 
-    if any(k in txt for k in ["оплат","відправ","готово","скинув","чек"]):
+    if PAID_RE.search(txt):
         r = "Дякую! Перевірю надходження та надішлю деталі!"
-        await typing_simulation(update, r)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_PAYMENT_CONFIRM, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_PAYMENT_CONFIRM
+        return await transition(update, context, r, STAGE_ZOO_PAYMENT_CONFIRM)
     else:
         rr = "Якщо виникнуть питання з оплатою — пишіть, я допоможу."
-        await typing_simulation(update, rr)
-        save_user_state(str(update.effective_user.id), STAGE_ZOO_PAYMENT, context.user_data)
-        schedule_no_response_job(context, update.effective_chat.id)
-        return STAGE_ZOO_PAYMENT
+        return await transition(update, context, rr, STAGE_ZOO_PAYMENT)
 
+@resets_no_response
 async def zoo_payment_confirm_handler(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
     r = (
         "Дякую за бронювання! Ваше місце офіційно заброньовано. "
         "Незабаром надішлю повну інформацію. Якщо будуть питання — звертайтесь!"
@@ -994,8 +1336,8 @@ async def zoo_payment_confirm_handler(update:Update, context:ContextTypes.DEFAUL
 # ============================
 # /cancel
 # ============================
+@resets_no_response
 async def cancel_command(update:Update, context:ContextTypes.DEFAULT_TYPE):
-    cancel_no_response_job(context)
     logger.info("User canceled conversation")
     t = "Добре, завершуємо розмову. Якщо виникнуть питання, звертайтесь знову!"
     await typing_simulation(update, t)
@@ -1009,111 +1351,93 @@ async def global_fallback_handler(update:Update, context:ContextTypes.DEFAULT_TY
     Сюда попадаем, если ConversationHandler не забрал сообщение
     (т.е. никакой стейт не подошёл).
     """
+    # Группы хендлеров обходятся все подряд: на этот апдейт уже ответил диалог в group=0
+    if update.update_id in conversation_updates:
+        conversation_updates.discard(update.update_id)
+        return
     user_text = update.message.text.strip()
     gpt_text = await gpt_fallback_response(user_text, context)
     await typing_simulation(update, gpt_text)
 
 # ============================
-# Flask endpoints
+# HTTP endpoints (aiohttp на том же event loop, что и бот)
 # ============================
-@app.route('/')
-def index():
-    return "Сервер працює! Бот активний."
-
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    if request.method == "POST":
-        data = request.get_json(force=True)
-        global application
-        if not application:
-            logger.error("No application.")
-            return "No application"
-        update = Update.de_json(data, application.bot)
-        loop = application.bot_data.get("loop")
-        if loop:
-            asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
-        else:
-            logger.error("No event loop to process update.")
-    return "OK"
+# Апдейты из webhook кладутся в ограниченную application.update_queue;
+# разбирает её сам PTB, не больше MAX_CONCURRENT_UPDATES одновременно
+UPDATE_QUEUE_SIZE = 10_000
+MAX_CONCURRENT_UPDATES = 256
+
+routes = web.RouteTableDef()
+
+@routes.get('/')
+async def index(request: web.Request) -> web.Response:
+    return web.Response(text="Сервер працює! Бот активний.")
+
+@routes.post('/webhook')
+async def webhook(request: web.Request) -> web.Response:
+    if _update_queue is None:
+        logger.error("No application.")
+        return web.Response(text="No application")
+    data = orjson.loads(await request.read())
+    update = Update.de_json(data, _bot)
+    try:
+        _update_queue.put_nowait(update)
+    except asyncio.QueueFull:
+        # Telegram повторит доставку позже
+        logger.warning("Update queue is full, asking Telegram to retry.")
+        return web.Response(status=429, text="Too Many Requests")
+    return web.Response(text="OK")
+
+app = web.Application()
+app.add_routes(routes)
 
 async def setup_webhook(url:str, app_ref):
     wh_url = f"{url}/webhook"
     await app_ref.bot.set_webhook(wh_url)
     logger.info("Webhook set to %s", wh_url)
 
+async def open_state_db(app_ref):
+    """Один раз открывает БД в потоке-писателе, не блокируя loop"""
+    if PERSIST_STATE:
+        await asyncio.get_running_loop().run_in_executor(db_executor, init_db)
+
 async def run_bot():
-    if is_bot_already_running():
+    if not acquire_instance_lock():
         logger.error("Another instance is running. Exiting.")
         sys.exit(1)
     logger.info("Starting bot...")
 
-    req = HTTPXRequest(connect_timeout=20, read_timeout=40)
+    # Пул соединений к api.telegram.org, чтобы ответы разным чатам уходили параллельно
+    # HTTP/2: параллельные запросы мультиплексируются в одном TLS-соединении
+    req = HTTPXRequest(
+        connection_pool_size=256,
+        connect_timeout=20,
+        read_timeout=40,
+        pool_timeout=1.0,
+        http_version="2",
+    )
     global application
-    builder = ApplicationBuilder().token(BOT_TOKEN).request(req)
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(req)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .updater(None)  # webhook принимает наш aiohttp-сервер
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        # Общий лимит Telegram ~30 сообщений/с: оставляем запас и повторяем после RetryAfter
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=2))
+    )
     application = builder.build()
 
+    # Все стадии ведёт message_handler — один общий список хендлеров вместо 19 копий.
+    # Хендлеры диалога блокирующие: иначе до отправки ответа диалог в PendingState и следующее
+    # сообщение пользователя никуда не попадает. Другие чаты не ждут — их держит concurrent_updates
+    text_handlers = [MessageHandler(TEXT_NOCMD, message_handler)]
+
     # ConversationHandler
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start_command)],
-        states={
-            STAGE_SCENARIO_CHOICE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_CAMP_PHONE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_CAMP_NO_PHONE_QA: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_CAMP_CITY: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_CAMP_CHILDREN: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_CAMP_DETAILED: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_CAMP_END: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_GREET: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_DEPARTURE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_TRAVEL_PARTY: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_CHILD_AGE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_CHOICE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_DETAILS: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_QUESTIONS: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_IMPRESSION: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_CLOSE_DEAL: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_PAYMENT: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_PAYMENT_CONFIRM: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ],
-            STAGE_ZOO_END: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)
-            ]
-        },
+        states={stage: text_handlers for stage in ALL_STAGES},
         fallbacks=[CommandHandler('cancel', cancel_command)],
         allow_reentry=True
     )
@@ -1121,27 +1445,68 @@ async def run_bot():
 
     # Глобальный fallback (если ConversationHandler не перехватил)
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, global_fallback_handler),
+        MessageHandler(TEXT_NOCMD, global_fallback_handler, block=False),
         group=1
     )
 
     # Настройка webhook
     await setup_webhook(WEBHOOK_URL, application)
     await application.initialize()
+    # post_init PTB вызывает только из run_polling/run_webhook, поэтому зовём сами
+    await open_state_db(application)
     await application.start()
 
-    loop = asyncio.get_running_loop()
-    application.bot_data["loop"] = loop
+    if PERSIST_STATE:
+        application.bot_data["state_flusher"] = asyncio.create_task(state_flusher())
+    application.bot_data["no_response_watcher"] = asyncio.create_task(no_response_watcher(application.bot))
+    global _bot, _update_queue
+    _bot = application.bot
+    _update_queue = application.update_queue
 
     logger.info("Bot is online and ready.")
 
-def start_flask():
+async def start_web_server() -> web.AppRunner:
     port = int(os.environ.get('PORT', 10000))
-    logger.info(f"Starting Flask on port {port}")
-    app.run(host='0.0.0.0', port=port)
+    # Без access-лога на каждый POST; keep-alive, чтобы Telegram переиспользовал соединения
+    runner = web.AppRunner(app, access_log=None, keepalive_timeout=75)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logger.info(f"HTTP server listening on port {port}")
+    return runner
+
+async def main():
+    if sys.version_info >= (3, 12):
+        # Задача выполняется сразу до первого await; апдейты без I/O обходятся без планировщика
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    await run_bot()
+    runner = await start_web_server()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        await application.shutdown()
+        # Изменения, не дождавшиеся окна сброса, пишем перед выходом
+        if PERSIST_STATE:
+            flusher = application.bot_data["state_flusher"]
+            flusher.cancel()
+            # Дожидаемся отмены: прерванный на записи сброс должен успеть вернуть пачку в dirty_users
+            try:
+                await flusher
+            except asyncio.CancelledError:
+                pass
+            await flush_user_states()
+        if openai_session is not None:
+            await openai_session.close()
 
 if __name__=="__main__":
-    bot_thread = threading.Thread(target=lambda: asyncio.run(run_bot()), daemon=True)
-    bot_thread.start()
-    logger.info("Bot thread started. Now starting Flask...")
-    start_flask()
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(main())